@@ -0,0 +1,85 @@
+"""
+GPU backend for despatch(), using CuPy's implementation of scipy's
+map_coordinates. CuPy is an optional dependency: if it is not installed,
+HAVE_CUPY will be False and the backend cannot be used. It is imported on
+first use.
+"""
+
+import importlib.util
+
+import numpy as np
+
+# cupy is slow to import, so it is only imported when the backend is used
+HAVE_CUPY = importlib.util.find_spec('cupy') is not None
+
+
+def despatch(data, transform, src_spc, ref_spc, series_length, **kwargs):
+    """
+    Apply a transform to an array of data on the GPU. The data is uploaded
+    once and the output downloaded once, all frames being interpolated,
+    clipped, scaled and supersampled on the device in between. The cache
+    of the transform must already have been prepared. For linear transforms,
+    the voxel coordinates of each frame are also computed on the device
+    from the transform's voxel_matrix(); other transforms resolve their
+    coordinates on the host.
+
+    Args:
+        data (np.ndarray): 3D or 4D image data
+        transform (Transformation): between source and reference space
+        src_spc (ImageSpace): in which data currently lies
+        ref_spc (ImageSpace): towards which data will be transformed
+        series_length (int): number of frames in the output
+        **kwargs: superfactor, and kwargs for map_coordinates
+
+    Returns:
+        (np.ndarray) transformed data, 4D (last dimension series_length)
+    """
+
+    if not HAVE_CUPY:
+        raise RuntimeError("cupy is required for the 'cupy' backend")
+
+    import cupy
+    from cupyx.scipy.ndimage import map_coordinates
+
+    # Avoid a circular import
+    from regtricks.application_helpers import clip_and_scale
+
+    superfactor = kwargs.pop('superfactor')
+    data_gpu = cupy.asarray(data)
+    out_size = tuple(ref_spc.size // superfactor)
+    out_gpu = cupy.empty((*out_size, series_length), dtype=data_gpu.dtype)
+
+    # Homogeneous voxel grid of the reference (4xN), for linear transforms
+    ijk = ref_spc.ijk_grid('ij').reshape(-1, 3).T
+    grid = cupy.vstack((cupy.asarray(ijk, dtype=data_gpu.dtype), 
+                        cupy.ones((1, ijk.shape[1]), dtype=data_gpu.dtype)))
+
+    # Coordinates are only uploaded or calculated when they change
+    # (Registrations return the same matrix and coordinates for every frame)
+    last, ijk_gpu = None, None
+
+    for idx in range(series_length):
+        if data_gpu.ndim == 4:
+            vol = cupy.ascontiguousarray(data_gpu[...,idx])
+        else:
+            vol = data_gpu
+
+        mat = transform.voxel_matrix(idx)
+        if mat is not None: 
+            scale = 1 
+            if mat is not last: 
+                last = mat 
+                ijk_gpu = cupy.asarray(mat, dtype=data_gpu.dtype) @ grid
+        else:
+            ijk, scale = transform.resolve(src_spc, ref_spc, idx)
+            if ijk is not last:
+                last, ijk_gpu = ijk, cupy.asarray(ijk)
+            if not np.isscalar(scale): 
+                scale = cupy.asarray(scale)
+
+        interp = map_coordinates(vol, ijk_gpu, **kwargs)
+        out_gpu[...,idx] = clip_and_scale(interp, vol, scale, ref_spc.size, 
+                                          superfactor, kwargs.get('cval'), 
+                                          xp=cupy)
+
+    return cupy.asnumpy(out_gpu)
@@ -0,0 +1,172 @@
+"""
+Compiled interpolation kernels, used in place of scipy map_coordinates
+where possible. Numba is an optional dependency: if it is not installed,
+HAVE_NUMBA will be False and callers should fall back to scipy.
+"""
+
+import threading
+import multiprocessing as mp
+
+import numpy as np
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+if HAVE_NUMBA:
+
+    @numba.njit(inline='always', nogil=True, cache=True)
+    def _sample(data, x, y, z, cval):
+        """
+        Trilinear interpolation of data at a single point (x,y,z). Points
+        outside the voxel grid return cval, as for map_coordinates with
+        mode constant (there is no interpolation beyond the edges).
+        """
+
+        nx, ny, nz = data.shape
+        if not ((0 <= x <= nx - 1) and (0 <= y <= ny - 1)
+                and (0 <= z <= nz - 1)):
+            return cval
+
+        i0 = int(np.floor(x))
+        j0 = int(np.floor(y))
+        k0 = int(np.floor(z))
+        i1 = min(i0 + 1, nx - 1)
+        j1 = min(j0 + 1, ny - 1)
+        k1 = min(k0 + 1, nz - 1)
+        fx = x - i0
+        fy = y - j0
+        fz = z - k0
+
+        c00 = data[i0,j0,k0] * (1 - fx) + data[i1,j0,k0] * fx
+        c01 = data[i0,j0,k1] * (1 - fx) + data[i1,j0,k1] * fx
+        c10 = data[i0,j1,k0] * (1 - fx) + data[i1,j1,k0] * fx
+        c11 = data[i0,j1,k1] * (1 - fx) + data[i1,j1,k1] * fx
+        c0 = c00 * (1 - fy) + c10 * fy
+        c1 = c01 * (1 - fy) + c11 * fy
+        return c0 * (1 - fz) + c1 * fz
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _trilinear_parallel(data, ijk, cval, out):
+        for n in numba.prange(out.size):
+            out[n] = _sample(data, ijk[0,n], ijk[1,n], ijk[2,n], cval)
+
+    @numba.njit(nogil=True, cache=True)
+    def _trilinear_serial(data, ijk, cval, out):
+        for n in range(out.size):
+            out[n] = _sample(data, ijk[0,n], ijk[1,n], ijk[2,n], cval)
+
+    @numba.njit(inline='always', nogil=True, cache=True)
+    def _affine_plane(data, mat, i, ny, nz, cval, out):
+        """
+        Trilinear interpolation of the plane i of the reference grid, the 
+        coordinates of which are mapped into data by the 3x4 affine mat. 
+        """
+
+        n = i * ny * nz
+        for j in range(ny):
+            for k in range(nz):
+                # Same order of operations as aff_trans(), so that points
+                # on the edges of the data are treated identically
+                x = (mat[0,0] * i + mat[0,1] * j + mat[0,2] * k) + mat[0,3]
+                y = (mat[1,0] * i + mat[1,1] * j + mat[1,2] * k) + mat[1,3]
+                z = (mat[2,0] * i + mat[2,1] * j + mat[2,2] * k) + mat[2,3]
+                out[n] = _sample(data, x, y, z, cval)
+                n += 1
+
+    @numba.njit(parallel=True, nogil=True, cache=True)
+    def _affine_parallel(data, mat, nx, ny, nz, cval, out):
+        for i in numba.prange(nx):
+            _affine_plane(data, mat, i, ny, nz, cval, out)
+
+    @numba.njit(nogil=True, cache=True)
+    def _affine_serial(data, mat, nx, ny, nz, cval, out):
+        for i in range(nx):
+            _affine_plane(data, mat, i, ny, nz, cval, out)
+
+
+def trilinear(data, ijk, cval=0.0, out=None, cores=1):
+    """
+    Trilinear interpolation of 3D data onto voxel coordinates, equivalent
+    to scipy map_coordinates(data, ijk, order=1, mode='constant'). The GIL
+    is released during interpolation. When called from the main thread of
+    the main process, the voxels are shared across up to cores threads; 
+    from within a worker (thread or process) a single core is used to 
+    avoid nested parallelism.
+
+    Args:
+        data (np.ndarray): 3D, image data
+        ijk (np.ndarray): (3,N) voxel coordinates to interpolate onto
+        cval (float): fill value for points outside the voxel grid
+        out (np.ndarray): optional, N-length array to write into
+        cores (int): maximum number of threads to use (default 1)
+
+    Returns:
+        (np.ndarray) interpolated output, sized N
+    """
+
+    if not HAVE_NUMBA:
+        raise RuntimeError("numba is required for compiled interpolation")
+
+    if out is None:
+        out = np.empty(ijk.shape[1], dtype=data.dtype)
+
+    _run(_trilinear_parallel, _trilinear_serial, cores, data, ijk, cval, out)
+    return out
+
+
+def affine_trilinear(data, mat, size, cval=0.0, out=None, cores=1):
+    """
+    Trilinear interpolation of 3D data onto a voxel grid of given size,
+    mapped into the voxel coordinates of data by an affine. As trilinear(),
+    but the coordinates of each voxel are calculated as they are needed
+    within the loop over the grid, so no array of coordinates is formed.
+
+    Args:
+        data (np.ndarray): 3D, image data
+        mat (np.ndarray): 3x4 affine, grid voxels to data voxels
+        size (np.ndarray): 3-vector, shape of the grid
+        cval (float): fill value for points outside the voxel grid
+        out (np.ndarray): optional, prod(size) array to write into
+        cores (int): maximum number of threads to use (default 1)
+
+    Returns:
+        (np.ndarray) interpolated output, sized prod(size), in the order
+            of a C-ordered array of shape size
+    """
+
+    if not HAVE_NUMBA:
+        raise RuntimeError("numba is required for compiled interpolation")
+
+    nx, ny, nz = [ int(s) for s in size ]
+    if out is None:
+        out = np.empty(nx * ny * nz, dtype=data.dtype)
+
+    mat = np.ascontiguousarray(mat, dtype=np.float64)
+    _run(_affine_parallel, _affine_serial, cores, 
+         data, mat, nx, ny, nz, cval, out)
+    return out
+
+
+def _run(parallel, serial, cores, *args):
+    """
+    Call the parallel variant of a kernel with at most cores threads, 
+    or the serial variant if cores is 1. Only the main thread of the 
+    main process runs in parallel; within a worker (thread or process) 
+    kernels run on a single core to avoid nested parallelism.
+    """
+
+    if ((cores > 1) 
+        and (threading.current_thread() is threading.main_thread())
+        and (mp.parent_process() is None)):
+        previous = numba.get_num_threads()
+        numba.set_num_threads(min(cores, numba.config.NUMBA_NUM_THREADS))
+        try:
+            parallel(*args)
+        finally:
+            numba.set_num_threads(previous)
+    else:
+        serial(*args)
@@ -0,0 +1,126 @@
+"""
+PyTorch backend for despatch(), using grid_sample to interpolate batches
+of frames at once on the GPU (or CPU, if CUDA is not available). PyTorch
+is an optional dependency: if it is not installed, HAVE_TORCH will be
+False and the backend cannot be used. It is imported on first use.
+"""
+
+import importlib.util
+
+import numpy as np
+
+# torch is slow to import, so it is only imported when the backend is used
+HAVE_TORCH = importlib.util.find_spec('torch') is not None
+
+# Upper limit on the number of voxel coordinates held at once, which sets
+# the number of frames sampled in each batch
+BATCH_VOXELS = 2 ** 25
+
+
+def despatch(data, transform, src_spc, ref_spc, series_length, **kwargs):
+    """
+    Apply a transform to an array of data using torch grid_sample. Frames
+    are stacked along the batch dimension, each with its own sampling grid,
+    so there is no loop over frames within a batch. Only nearest neighbour
+    (order 0) and linear (order 1) interpolation with mode constant are
+    supported. The cache of the transform must already have been prepared.
+    For linear transforms, the voxel coordinates of each frame are computed
+    on the device from the transform's voxel_matrix(); other transforms 
+    resolve their coordinates on the host.
+
+    Args:
+        data (np.ndarray): 3D or 4D image data
+        transform (Transformation): between source and reference space
+        src_spc (ImageSpace): in which data currently lies
+        ref_spc (ImageSpace): towards which data will be transformed
+        series_length (int): number of frames in the output
+        **kwargs: superfactor, order, mode, cval
+
+    Returns:
+        (np.ndarray) transformed data, 4D (last dimension series_length)
+    """
+
+    if not HAVE_TORCH:
+        raise RuntimeError("torch is required for the 'torch' backend")
+
+    superfactor = kwargs.pop('superfactor')
+    order = kwargs.pop('order', 3)
+    mode = kwargs.pop('mode', 'constant')
+    clip_cval = kwargs.get('cval')
+    cval = kwargs.pop('cval', 0.0)
+    if (order not in (0, 1)) or (mode != 'constant'):
+        raise ValueError("The torch backend supports order 0 or 1 with "
+                         "mode constant only")
+    if kwargs:
+        raise ValueError("Unsupported arguments for the torch backend: "
+                         "{}".format(", ".join(kwargs)))
+
+    import torch
+    from torch.nn.functional import grid_sample
+
+    # Avoid a circular import
+    from regtricks.application_helpers import clip_and_scale
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    src_data = torch.as_tensor(data, device=device)
+    dtype = src_data.dtype
+
+    # Frames at the front: T, XYZ. A 3D volume is expanded (without copy)
+    # to the length of the series
+    if src_data.ndim == 4:
+        src_data = src_data.permute(3, 0, 1, 2)
+    else:
+        src_data = src_data.expand(series_length, *src_data.shape)
+
+    # grid_sample's grid is ordered (W,H,D), ie, (K,J,I) for an XYZ volume,
+    # and normalised to [-1,1] across the voxel centres (align_corners)
+    bounds = torch.as_tensor(data.shape[:3], device=device, dtype=dtype) - 1
+    ref_size = tuple(int(s) for s in ref_spc.size)
+    out_size = tuple(ref_spc.size // superfactor)
+    interp_mode = 'nearest' if order == 0 else 'bilinear'
+
+    # Homogeneous voxel grid of the reference (4xN), for linear transforms
+    ijk = torch.as_tensor(ref_spc.ijk_grid('ij').reshape(-1, 3).T, 
+                          device=device, dtype=dtype)
+    grid = torch.cat((ijk, torch.ones_like(ijk[:1])))
+
+    resamp = torch.empty((series_length, *out_size), device=device,
+                         dtype=dtype)
+    batch = max(1, BATCH_VOXELS // int(np.prod(ref_size)))
+    for start in range(0, series_length, batch):
+        idx = range(start, min(start + batch, series_length))
+        vols = src_data[idx.start:idx.stop]
+
+        # Linear transforms: one voxel matrix per frame, applied to the
+        # reference grid on the device 
+        mats = [ transform.voxel_matrix(t) for t in idx ]
+        if all(m is not None for m in mats):
+            mats = torch.stack([ torch.as_tensor(m, device=device, 
+                                    dtype=dtype) for m in mats ])
+            ijk = mats @ grid
+            scales = [ 1 ] * len(idx)
+        else:
+            ijk, scales = zip(*[ transform.resolve(src_spc, ref_spc, t)
+                                 for t in idx ])
+            ijk = torch.stack([ torch.as_tensor(c, device=device,
+                                    dtype=dtype) for c in ijk ])
+            scales = [ s if np.isscalar(s) else 
+                       torch.as_tensor(s, device=device, dtype=dtype)
+                       for s in scales ]
+
+        # map_coordinates does not interpolate beyond the edges of the
+        # data with constant mode: mask out such points after sampling
+        outside = ((ijk < 0) | (ijk > bounds[:,None])).any(1)
+        ijk = 2 * ijk / bounds.clamp(min=1)[:,None] - 1
+        ijk = ijk.flip(1).transpose(1, 2).reshape(len(idx), *ref_size, 3)
+        interp = grid_sample(vols[:,None], ijk, mode=interp_mode,
+                             padding_mode='zeros', align_corners=True)
+        interp = interp[:,0].reshape(len(idx), -1)
+        interp[outside] = cval
+
+        for n, scale in enumerate(scales):
+            resamp[idx.start + n] = clip_and_scale(interp[n], vols[n], 
+                                        scale, ref_size, superfactor, 
+                                        clip_cval, xp=torch)
+
+    return np.moveaxis(resamp.cpu().numpy(), 0, -1)
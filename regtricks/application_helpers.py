@@ -1,5 +1,7 @@
 import functools
 import multiprocessing as mp 
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ThreadPoolExecutor
 import tempfile 
 import os.path as op 
 import subprocess
@@ -9,26 +11,38 @@ import itertools
 
 import nibabel
 from nibabel import Nifti1Image, MGHImage
+from nibabel.spatialimages import SpatialImage
 from fsl.data.image import Image as FSLImage
 from fsl.wrappers import applywarp
 import numpy as np 
 from scipy.ndimage import map_coordinates
 
 from regtricks.image_space import ImageSpace
+from regtricks import _interp, _cupy, _torch
 
 
 def src_load_helper(src):
+    """
+    Load the data of an image for transformation. Data is read via the 
+    image's dataobj in its stored dtype (with any scaling applied), which 
+    avoids the float64 copy made by get_fdata() and allows uncompressed
+    images to be memory-mapped. Resampling is performed in float32, to 
+    which all other data types are converted. 
+    """
+
     if isinstance(src, str):
         src = nibabel.load(src)
-        data = src.get_fdata()
-    elif isinstance(src, (Nifti1Image, MGHImage)):
-        data = src.get_fdata()
-    elif isinstance(src, FSLImage):
+
+    if isinstance(src, FSLImage):
         data = src.data
+    elif isinstance(src, SpatialImage):
+        data = np.asanyarray(src.dataobj)
     else: 
-        raise RuntimeError("src must be a nibabel Nifti/MGH, FSL Image," 
+        raise RuntimeError("src must be a nibabel image, FSL Image," 
                            " or path to image")
 
+    data = data.astype(np.float32, copy=False)
+
     return data, type(src)
 
 
@@ -47,54 +61,228 @@ def _make_iterable(data, series_length):
         return [ data ] * series_length
 
 
-def interpolate_and_scale(idx, data, transform, src_spc, ref_spc, **kwargs):
+def _is_plain_linear(kwargs):
+    """
+    True if map_coordinates kwargs request linear interpolation with 
+    constant mode and nothing else, which the compiled kernels replicate. 
+    """
+
+    return ((kwargs.get('order', 3) == 1) 
+            and (kwargs.get('mode', 'constant') == 'constant') 
+            and not (set(kwargs) - {'order', 'mode', 'cval'}))
+
+
+def _is_separable(mat):
+    """
+    True if a voxel affine (3x4) only scales and translates along each 
+    axis, so that interpolation can be separated into 1D passes. 
+    """
+
+    return (mat is not None) and (np.abs(mat[:,:3] 
+                - np.diag(np.diag(mat[:,:3]))).max() < 1e-8)
+
+
+def _separable_linear(data, mat, size, cval=0.0):
+    """
+    Linear interpolation of data onto the voxel grid of size, mapped into
+    data's voxel coordinates by a diagonal affine mat (see _is_separable).
+    Equivalent to map_coordinates(order=1, mode='constant') on the full 
+    grid of coordinates, but performed as three 1D linear interpolations, 
+    one along each axis in turn. 
+
+    Args: 
+        data (np.ndarray): 3D, image data 
+        mat (np.ndarray): 3x4 affine, reference voxels to data voxels
+        size (np.ndarray): 3-vector, shape of reference grid 
+        cval (float): fill value for points outside the voxel grid
+
+    Returns: 
+        (np.ndarray) interpolated output, sized N (= prod(size))
+    """
+
+    interp = data 
+    outside = []
+    for axis in range(3): 
+        n = data.shape[axis]
+        coords = (mat[axis,axis] * np.arange(size[axis])) + mat[axis,3]
+        outside.append((coords < 0) | (coords > n - 1))
+
+        lo = np.clip(np.floor(coords).astype(int), 0, n - 1)
+        hi = np.minimum(lo + 1, n - 1)
+        frac = (coords - lo).reshape([-1 if a == axis else 1 
+                                      for a in range(3)])
+
+        # Written as lower + frac * (upper - lower), in place. Axes that 
+        # are aligned to the voxel grid only need a gather 
+        lower = np.take(interp, lo, axis)
+        if frac.any(): 
+            interp = np.take(interp, hi, axis)
+            interp -= lower 
+            interp *= frac 
+            interp += lower 
+        else: 
+            interp = lower 
+
+    # map_coordinates does not interpolate beyond the edges of the 
+    # data with constant mode 
+    interp[outside[0],:,:] = cval 
+    interp[:,outside[1],:] = cval 
+    interp[:,:,outside[2]] = cval 
+    return interp.reshape(-1)
+
+
+def interpolate_and_scale(idx, data, transform, src_spc, ref_spc, out=None, 
+                          cores=1, **kwargs):
     """
-    Used for partial function application to share interpolation jobs
-    amongst workers of a mp.Pool(). Interpolate data onto the coordinates
-    given in the tuple coords_scale, and multiply the output by the other
-    value in coords_scale. Reshape the output to size out_size. 
+    Interpolate one volume of data onto the reference grid, as described 
+    by volume idx of transform, then clip, scale (intensity correction) 
+    and, if supersampling, sum blocks back down to the output size. Used 
+    by despatch(), where volumes are shared amongst threads (or processes)
+    by partial application of this function. 
 
     Args: 
+        idx (int): index of the volume within the series of transforms
         data (np.ndarray): 3D, image data 
-        coords_scale (np.ndarray, np.ndarray): (N,3) coordinates to interpolate
-            onto (indices into data array), value by which to scale output
-            (int or another np.ndarray for intensity correction)
-        out_size (np.ndarray): 3-vector, shape of output
-        **kwargs: passed onto scipy map_coordinates
+        transform (Transformation): between source and reference space, 
+            the cache of which has been prepared 
+        src_spc (ImageSpace): in which data currently lies
+        ref_spc (ImageSpace): towards which data will be transformed (at 
+            supersampled resolution, if used)
+        out (np.ndarray): optional, array of output size to write into. 
+            If C-contiguous and there is no supersampling, the output is 
+            interpolated directly into it 
+        cores (int): threads the compiled kernels may use (default 1)
+        **kwargs: superfactor (3-vector), and kwargs for scipy 
+            map_coordinates (or the compiled trilinear kernel for linear 
+            interpolation)
 
     Returns: 
-       (np.ndarray), sized as out_size, interpolated output 
+       (np.ndarray), sized ref_spc.size // superfactor, interpolated output 
     """
 
-    # We transform a bool mask along with the input data to guard
-    # against spline interpolation artefacts in the transformed data 
+    # Linear transforms with a different matrix for each volume are not
+    # resolved into a full grid of coordinates: the compiled kernel maps
+    # each voxel as it goes or, without numba, axis-aligned transforms 
+    # are interpolated one axis at a time. A Registration has already 
+    # cached its coordinates, which the compiled kernel reads directly. 
     superfactor = kwargs.pop('superfactor')
-    ijk, scale = transform.resolve(src_spc, ref_spc, idx)
-    interp = map_coordinates(data, ijk, **kwargs)
+    mat = transform.voxel_matrix(idx)
+    cval = kwargs.get('cval', 0.0)
+    linear = _is_plain_linear(kwargs) and (mat is not None)
+
+    # Without supersampling, the output slot can be interpolated into 
+    # directly, and is then clipped and scaled in place 
+    dest = None 
+    if ((out is not None) and (not (superfactor > 1).any()) 
+        and out.flags.c_contiguous and (out.dtype == data.dtype)): 
+        dest = out.reshape(-1)
+
+    if linear and _interp.HAVE_NUMBA and (len(transform) > 1): 
+        interp = _interp.affine_trilinear(data, mat, ref_spc.size, cval, 
+                                          out=dest, cores=cores)
+        scale = 1 
+    elif linear and (not _interp.HAVE_NUMBA) and _is_separable(mat): 
+        interp = _separable_linear(data, mat, ref_spc.size, cval)
+        scale = 1 
+    else: 
+        ijk, scale = transform.resolve(src_spc, ref_spc, idx)
+        if _interp.HAVE_NUMBA and _is_plain_linear(kwargs): 
+            interp = _interp.trilinear(data, ijk, cval, out=dest, 
+                                       cores=cores)
+        else: 
+            interp = map_coordinates(data, ijk, output=dest, **kwargs)
+
+    interp = clip_and_scale(interp, data, scale, ref_spc.size, superfactor, 
+                            kwargs.get('cval'))
+
+    if out is None: 
+        return interp
+    if not np.may_share_memory(interp, out): 
+        out[...] = interp 
+    return out
+
+
+def clip_and_scale(interp, data, scale, size, superfactor, cval=None, xp=np):
+    """
+    Post-processing of a freshly interpolated volume: clip to the range of
+    the input data (and fill value), reshape to the reference grid, apply 
+    intensity scaling and, if supersampling, average array blocks down to 
+    the output size. Work is done in place where possible. Shared by 
+    interpolate_and_scale() and the GPU backends, which pass their own 
+    array module. 
+
+    Args: 
+        interp (array): flat, interpolated values 
+        data (array): source volume, of the same array type as interp 
+        scale: 1, or array of intensity scale factors (same type as interp)
+        size (np.ndarray): 3-vector, size of the (supersampled) reference 
+        superfactor (np.ndarray): 3-vector, supersampling factor 
+        cval (float): fill value, if specified (default None)
+        xp (module): providing clip(a, min, max, out=), default numpy 
+
+    Returns: 
+        (array) sized size // superfactor 
+    """
 
     # If the fill value has been specified, set the min/max
     # range for clipping in light of this 
-    if 'cval' in kwargs:
-        cval = kwargs['cval']
-        cmin = data.min() if cval > data.min() else cval
-        cmax = data.max() if cval < data.max() else cval 
-    else: 
-        cmin = data.min() 
-        cmax = data.max()
+    cmin = float(data.min())
+    cmax = float(data.max())
+    if cval is not None:
+        cmin = min(cmin, cval)
+        cmax = max(cmax, cval)
 
-    # Clip output values to the required min max
-    interp = np.clip(interp, cmin, cmax)
-    interp = interp.reshape(ref_spc.size) * scale 
+    xp.clip(interp, cmin, cmax, out=interp)
+    interp = interp.reshape(tuple(int(s) for s in size))
+    if not (np.isscalar(scale) and (scale == 1)): 
+        interp *= scale 
 
     # If supersampling used, sum array blocks back down to target 
     if (superfactor > 1).any():
         interp = sum_array_blocks(interp, superfactor)
-        interp = interp / np.prod(superfactor)
-    
-    return interp
+        interp /= int(np.prod(superfactor))
+
+    return interp 
+
+
+# Per-process state for the workers of despatch(), see _init_process_worker()
+_WORKER_STATE = None 
+
 
+def _init_process_worker(data_spec, out_spec, transform, src_spc, 
+                         ref_spc, kwargs):
+    """
+    Initialiser for the workers of a mp.Pool used by despatch(). The input
+    and output arrays are attached from shared memory once per worker, so 
+    that tasks only need to pass the index of the frame to process. 
 
-def despatch(data, transform, src_spc, ref_spc, cores, **kwargs):
+    Args: 
+        data_spec (str, tuple, dtype): shared memory name, shape and dtype
+            of input data (3D or 4D)
+        out_spec (str, tuple, dtype): as above, for 4D output array (TXYZ)
+        transform, src_spc, ref_spc, kwargs: as for interpolate_and_scale
+    """
+
+    global _WORKER_STATE
+    shms = [ SharedMemory(name=spec[0]) for spec in (data_spec, out_spec) ]
+    data, out = [ np.ndarray(spec[1], dtype=spec[2], buffer=shm.buf) 
+                  for spec, shm in zip((data_spec, out_spec), shms) ]
+    _WORKER_STATE = dict(shms=shms, data=data, out=out, transform=transform,
+                         src_spc=src_spc, ref_spc=ref_spc, kwargs=kwargs)
+
+
+def _process_worker(idx):
+    """Interpolate frame idx of the shared input into the shared output"""
+
+    state = _WORKER_STATE
+    data = state['data']
+    vol = data[...,idx] if data.ndim == 4 else data 
+    interpolate_and_scale(idx, vol, state['transform'], state['src_spc'], 
+        state['ref_spc'], out=state['out'][idx], **state['kwargs'])
+
+
+def despatch(data, transform, src_spc, ref_spc, cores, backend='thread', 
+             **kwargs):
     """
     Apply a transform to an array of data, mapping from source space 
     to reference. Essentially this is an extended wrapper for Scipy 
@@ -105,7 +293,16 @@ def despatch(data, transform, src_spc, ref_spc, cores, **kwargs):
         transform (Transformation): between source and reference space 
         src_spc (ImageSpace): in which data currently lies
         ref_spc (ImageSpace): towards which data will be transformed
-        cores (int): number of cores to use (for 4D data)
+        cores (int): number of cores to use (volumes of 4D data are 
+            distributed amongst them, a single volume is shared by them
+            if interpolated by a compiled kernel)
+        backend (str): 'thread' (default) or 'process', how to distribute
+            the volumes of 4D data amongst cores. Threads share memory 
+            directly; processes attach to the data via shared memory (and
+            are started afresh, so the calling script must be guarded by
+            if __name__ == '__main__'). 'cupy' runs on the GPU instead,
+            as does 'torch' (order 0 or 1 only, on CPU if there is no 
+            GPU); cores is ignored for both.
         **kwargs: passed onto scipy.ndimage.interpolate.map_coordinates
 
     Returns: 
@@ -120,36 +317,108 @@ def despatch(data, transform, src_spc, ref_spc, cores, **kwargs):
         raise RuntimeError("Number of volumes in 4D series does not match "
                 "length of transformation series")
 
+    if backend not in ('thread', 'process', 'cupy', 'torch'): 
+        raise ValueError("backend must be 'thread', 'process', 'cupy' "
+                         "or 'torch'")
+
     if len(transform) == 1: 
         series_length = 1 if data.ndim == 3 else data.shape[3]
     else: 
         series_length = len(transform)
 
-    # Make the data 4D so that the workers of the pool can iterate over it 
-    # Each worker recieves a tuple of (vol, idx), one frame of the series and
-    # its corresponding index number (which is used to get the correct bit
-    # of the transform). Pre-calculate and cache any information that can be 
-    # shared amongst the workers 
-    data = _make_iterable(data, series_length)
-    transform.prepare_cache(ref_spc)
-    worker_args = zip(range(series_length), data)
-    worker = functools.partial(interpolate_and_scale, 
-        transform=transform, ref_spc=ref_spc, src_spc=src_spc, **kwargs)
-
-    # Distribute amongst workers 
-    if cores == 1:  
-        resamp = [ worker(*vc) for vc in worker_args ] 
-    else: 
-        with mp.Pool(cores) as p: 
-            resamp = p.starmap(worker, worker_args)
+    # Each frame of the series is written directly into its slot of the 
+    # output array (the final size of which accounts for supersampling). 
+    # Frames are stored first (TXYZ) so that each slot is contiguous, and 
+    # moved to the last axis when done. Pre-calculate and cache any 
+    # information that can be shared amongst the workers 
+    out_size = tuple(ref_spc.size // kwargs['superfactor'])
+    out_shape = (series_length, *out_size)
+    transform.prepare_cache(src_spc, ref_spc)
+
+    try: 
+        if backend == 'cupy': 
+            resamp = _cupy.despatch(data, transform, src_spc, ref_spc, 
+                                    series_length, **kwargs)
+
+        elif backend == 'torch': 
+            resamp = _torch.despatch(data, transform, src_spc, ref_spc, 
+                                     series_length, **kwargs)
+
+        elif (cores > 1) and (series_length > 1) and (backend == 'process'): 
+            resamp = _despatch_processes(data, out_shape, transform, 
+                                         src_spc, ref_spc, cores, kwargs)
+            resamp = np.moveaxis(resamp, 0, -1)
+
+        else: 
+            # Make the data 4D so that each frame can be paired with its 
+            # index number (used to get the correct bit of the transform)
+            frames = _make_iterable(data, series_length)
+            resamp = np.empty(out_shape, dtype=data.dtype)
+            worker = functools.partial(interpolate_and_scale, 
+                transform=transform, ref_spc=ref_spc, src_spc=src_spc, 
+                **kwargs)
+
+            def store(idx, cores=1):
+                worker(idx, frames[idx], out=resamp[idx], cores=cores)
+
+            # A single volume is shared amongst cores by the compiled 
+            # kernels, otherwise each thread processes whole volumes 
+            if series_length == 1: 
+                store(0, cores)
+            elif cores == 1: 
+                for idx in range(series_length): 
+                    store(idx)
+            else: 
+                with ThreadPoolExecutor(cores) as pool: 
+                    list(pool.map(store, range(series_length)))
+            resamp = np.moveaxis(resamp, 0, -1)
 
-    # Stack all the individual volumes back up in time dimension 
-    # Clip the array to the original min/max values 
     # Reset the cache on the transform to be safe. 
-    transform.reset_cache()
-    resamp = np.stack(resamp, axis=3)
-    if resamp.shape[3] == 1: 
-        resamp = np.squeeze(resamp, axis=3) 
+    finally: 
+        transform.reset_cache()
+
+    if series_length == 1: 
+        resamp = resamp[...,0]
+    return resamp
+
+
+def _despatch_processes(data, out_shape, transform, src_spc, ref_spc, 
+                        cores, kwargs):
+    """
+    Process-based backend for despatch(). The input data is written once 
+    into shared memory (a 3D volume is not expanded into a series) and the 
+    workers write their output into a shared array, so no image data is 
+    pickled between processes. 
+    """
+
+    out_dtype = data.dtype
+    shm_in = SharedMemory(create=True, size=max(data.nbytes, 1))
+    shm_out = SharedMemory(create=True, 
+        size=max(int(np.prod(out_shape)) * out_dtype.itemsize, 1))
+
+    try: 
+        shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm_in.buf)
+        shared[:] = data 
+        out = np.ndarray(out_shape, dtype=out_dtype, buffer=shm_out.buf)
+        initargs = ((shm_in.name, data.shape, data.dtype), 
+                    (shm_out.name, out_shape, out_dtype), 
+                    transform, src_spc, ref_spc, kwargs)
+
+        # Workers are not forked from this process, as the threads of 
+        # compiled parallel kernels do not survive a fork 
+        methods = mp.get_all_start_methods()
+        ctx = mp.get_context('forkserver' if 'forkserver' in methods 
+                             else 'spawn')
+        with ctx.Pool(cores, _init_process_worker, initargs) as p: 
+            p.map(_process_worker, range(out_shape[0]))
+        resamp = np.array(out)
+        del shared, out 
+
+    finally: 
+        for shm in (shm_in, shm_out):
+            shm.close()
+            shm.unlink()
+
     return resamp
 
 
@@ -165,14 +434,16 @@ def aff_trans(matrix, points):
     else: 
         transpose = False 
 
-    p = np.ones((4, points.shape[1]))
-    p[:3,:] = points 
-    t = matrix @ p 
+    # Equivalent to the homogeneous product, without padding the 
+    # points with a row of ones: rotate/scale, then translate 
+    matrix = np.asarray(matrix, dtype=float)
+    t = matrix[:3,:3] @ points 
+    t += matrix[:3,3:4]
 
     if transpose: 
-        return t[:3,:].T
+        return t.T
     else: 
-        return t[:3,:]
+        return t
 
 def sum_array_blocks(array, factor):
     """Sum sub-arrays of a larger array, each of which is sized according to factor. 
@@ -199,22 +470,12 @@ def sum_array_blocks(array, factor):
         raise RuntimeError(("Factor {} must be a perfect divisor of array shape {}".
             format(factor, array.shape)))
 
+    # View each of the first three dimensions as (blocks, within-block), 
+    # without copying, and sum over all the within-block axes at once 
     outshape = [ int(s/f) for (s,f) in zip(array.shape, factor) ]
-    out = np.copy(array)
-
+    newshape = []
     for dim in range(3):
-        newshape = [0] * 4
-
-        for d in range(3):
-            if d < dim: 
-                newshape[d] = outshape[d]
-            elif d == dim: 
-                newshape[d+1] = factor[d]
-                newshape[d] = outshape[d]
-            else: 
-                newshape[d+1] = array.shape[d]
-
-        newshape = newshape + list(array.shape[3:])
-        out = np.sum(out.reshape(newshape), axis=dim+1)
+        newshape += [ outshape[dim], factor[dim] ]
+    newshape = newshape + list(array.shape[3:])
 
-    return out 
\ No newline at end of file
+    return array.reshape(newshape).sum(axis=(1,3,5))
@@ -6,6 +6,7 @@ import warnings
 
 import nibabel 
 import numpy as np 
+from scipy.ndimage import map_coordinates, spline_filter
 
 from regtricks.image_space import ImageSpace
 from regtricks.application_helpers import aff_trans
@@ -64,14 +65,13 @@ class FNIRTCoefficients(object):
                 warnings.warn("NonLinearRegistration.from_fnirt(): absolute "
                     + "displacement field detected, making relative.")
                 
-                ijk = ref.ijk_grid().reshape(-1,3)
-                ijk = aff_trans(ref.vox2FSL, ijk)
-                ijk = coeffs.get_fdata().reshape(-1,3) - ijk
+                ijk = coeffs.get_fdata().reshape(-1,3) - fsl_grid(ref)
                 coeffs = nibabel.Nifti1Image(ijk.reshape(*ref.size, 3), 
                          coeffs.affine, coeffs.header)
 
         # We now have either an absolute field, or coefficients volume 
         self.coefficients = coeffs 
+        self._disp_coeffs = None 
 
     @property
     def jmin(self):
@@ -81,6 +81,77 @@ class FNIRTCoefficients(object):
     def jmax(self):
         return self.constrain_jac[1]
 
+    @property
+    def constrained(self):
+        """True if the Jacobian of this warp is to be constrained"""
+        return (self.jmin is not None) and (self.jmax is not None)
+
+    def displacement_coefficients(self):
+        """
+        Cubic spline coefficients of the relative displacement field of this
+        warp, over the voxel grid of its reference space (with no postmat or
+        Jacobian constraint). These are calculated once, and then cached. 
+
+        Returns: 
+            (np.ndarray) sized (3,X,Y,Z), one volume for each of the X,Y,Z
+                components of displacement, in FSL coordinates 
+        """
+
+        if self._disp_coeffs is None: 
+            disp = (self.dense_field() - fsl_grid(self.ref_spc)).T
+            self._disp_coeffs = np.stack([ 
+                spline_filter(d.reshape(self.ref_spc.size), order=3, 
+                              mode='nearest') for d in disp ])
+        return self._disp_coeffs
+
+    def dense_field(self):
+        """
+        Absolute displacement field of this warp over the voxel grid of its
+        reference space, with no postmat or Jacobian constraint (equivalent
+        to get_field(self.coefficients, self.ref_spc)). Displacement fields
+        and FNIRT cubic spline coefficients are resolved in process, other
+        coefficient types via convertwarp. The spline coefficients of this
+        field are cached by displacement_coefficients(). 
+
+        Returns: 
+            (np.ndarray): Nx3 array of absolute positions of the reference 
+                voxels in the warp's source space, in FSL coordinates 
+        """
+
+        intent = self.coefficients.header.get_intent()[0]
+        if 'spline coef' not in intent: 
+            disp = self.coefficients.get_fdata().reshape(-1,3)
+            return fsl_grid(self.ref_spc) + disp 
+        elif intent == 'fnirt cubic spline coef': 
+            return cubic_bspline_field(self.coefficients, self.ref_spc)
+        else: 
+            return get_field(self.coefficients, self.ref_spc)
+
+    def prepare_displacements(self):
+        """Pre-compute any values needed for sample_displacements()"""
+        if not self.constrained: 
+            self.displacement_coefficients()
+
+    def sample_displacements(self, points):
+        """
+        Resolve the warp at arbitrary points, in process, by interpolating
+        the cached displacement field of the warp. 
+
+        Args: 
+            points (np.ndarray): Nx3, positions in the FSL coordinates of 
+                the warp's reference space 
+
+        Returns: 
+            (np.ndarray): Nx3 array of absolute positions of the points in 
+                the warp's source space, in FSL coordinates 
+        """
+
+        coeffs = self.displacement_coefficients()
+        ijk = aff_trans(self.ref_spc.FSL2vox, points).T 
+        disp = [ map_coordinates(c, ijk, order=3, mode='nearest', 
+                                 prefilter=False) for c in coeffs ]
+        return points + np.stack(disp, axis=1)
+
     def get_cache_value(self, ref, postmat):
         """
         Return cacheable values, if possible, else return None. 
@@ -103,7 +174,10 @@ class FNIRTCoefficients(object):
             same1 = True 
             pmat = postmat.to_fsl(self.ref_spc, ref)
 
-        if same1: 
+        if same1 and (not self.constrained): 
+            points = aff_trans(np.linalg.inv(pmat), fsl_grid(ref))
+            return self.sample_displacements(points)
+        elif same1: 
             return get_field(self.coefficients, ref, post=pmat, 
                              jmin=self.jmin, jmax=self.jmax)
         else: 
@@ -130,6 +204,14 @@ class FNIRTCoefficients(object):
         else: 
             p = postmat[at_idx]
         post = p.to_fsl(self.ref_spc, ref)
+
+        # Unless the Jacobian is constrained, map the reference voxels back
+        # through the postmat and sample the cached field, rather than 
+        # calling convertwarp for every postmat 
+        if not self.constrained: 
+            points = aff_trans(np.linalg.inv(post), fsl_grid(ref))
+            return self.sample_displacements(points)
+
         return get_field(self.coefficients, ref, post=post, jmin=self.jmin, 
                          jmax=self.jmax)
 
@@ -193,6 +275,17 @@ class NonLinearProduct(object):
     def jmax(self):
         return self.constrain_jac[1]
 
+    @property
+    def constrained(self):
+        """True if the Jacobian of this warp is to be constrained"""
+        return (self.jmin is not None) and (self.jmax is not None)
+
+    def prepare_displacements(self):
+        """Pre-compute any values needed to resolve displacements in process"""
+        if not self.constrained: 
+            self.warp1.displacement_coefficients()
+            self.warp2.displacement_coefficients()
+
     def get_cache_value(self, ref, postmat):
         """
         Return cacheable values, if possible, else return None. 
@@ -230,7 +323,9 @@ class NonLinearProduct(object):
 
         same = (same1 & same2)
 
-        if same: 
+        if same and (not self.constrained): 
+            return self._compose(ref, mmat, pmat)
+        elif same: 
             return get_field(self.warp1.coefficients, ref, 
                              coeff2=self.warp2.coefficients, mid=mmat, 
                              post=pmat, jmin=self.constrain_jac[0], 
@@ -263,10 +358,29 @@ class NonLinearProduct(object):
        
         mid = m.to_fsl(self.warp1.ref_spc, self.warp2.src_spc)
         post = p.to_fsl(self.warp2.ref_spc, ref)
+
+        # Unless the Jacobian is constrained, work backwards through the
+        # postmat, second warp, midmat and first warp in process, rather
+        # than calling convertwarp for every mid/postmat pair 
+        if not self.constrained: 
+            return self._compose(ref, mid, post)
+
         return get_field(self.warp1.coefficients, ref, 
                             coeff2=self.warp2.coefficients, mid=mid, post=post,
                             jmin=self.jmin, jmax=self.jmax)
 
+    def _compose(self, ref, mid, post):
+        """
+        Compose the two warps in process (without Jacobian constraint), by 
+        mapping the reference voxels back through the postmat, second warp, 
+        midmat and first warp. mid and post are in FSL terms. 
+        """
+
+        points = aff_trans(np.linalg.inv(post), fsl_grid(ref))
+        points = self.warp2.sample_displacements(points)
+        points = aff_trans(np.linalg.inv(mid), points)
+        return self.warp1.sample_displacements(points)
+
 
 def get_field(coeff1, ref, coeff2=None, mid=None, post=None, jmin=None, jmax=None):
     """
@@ -324,6 +438,75 @@ def get_field(coeff1, ref, coeff2=None, mid=None, post=None, jmin=None, jmax=Non
     return field 
 
 
+def cubic_bspline_field(coeffs, ref):
+    """
+    Resolve FNIRT cubic B-spline coefficients into an absolute displacement
+    field, in process (equivalent to convertwarp --absout without a postmat).
+    The 3D spline is a tensor product of 1D splines, so the displacements
+    over the reference voxel grid are obtained by contracting the 
+    coefficients with a 1D basis matrix along each axis. As for fslpy's 
+    CoefficientField, knot spacing (in voxels of the original reference) is
+    stored in the pixdims and the original reference pixdims in the intent
+    parameters. The affine used to initialise the registration (src FSL -> 
+    ref FSL) is stored in the sform; as in convertwarp (and unlike fslpy), 
+    its inverse is applied to the absolute field. 
+
+    Args: 
+        coeffs (nibabel NIFTI): FNIRT cubic spline coefficients
+        ref (ImageSpace): reference space of the warp 
+
+    Returns: 
+        np.ndarray, shape Nx3, as for get_field()
+    """
+
+    hdr = coeffs.header 
+    knots = np.array(hdr.get_zooms()[:3], dtype=float)
+    orig_pixdim = np.array([ hdr['intent_p1'], hdr['intent_p2'], 
+                             hdr['intent_p3'] ], dtype=float)
+    if (orig_pixdim > 0).all(): 
+        knots *= (orig_pixdim / ref.vox_size)
+
+    # Basis matrix for each axis, sized (reference voxels, coefficients):
+    # each reference voxel lies within the support of 4 coefficients. 
+    data = coeffs.get_fdata()
+    bases = [] 
+    for n_ref, n_coef, spacing in zip(ref.size, data.shape[:3], knots):
+        t = np.arange(n_ref) / spacing 
+        i = np.floor(t).astype(int)
+        u = t - i 
+        b = [ (1 - u) ** 3 / 6, 
+              (3 * u ** 3 - 6 * u ** 2 + 4) / 6, 
+              (-3 * u ** 3 + 3 * u ** 2 + 3 * u + 1) / 6, 
+              u ** 3 / 6 ]
+
+        basis = np.zeros((n_ref, n_coef))
+        for l in range(4): 
+            valid = ((i + l) >= 0) & ((i + l) < n_coef)
+            basis[valid, i[valid] + l] += b[l][valid]
+        bases.append(basis)
+
+    disp = np.einsum('xa,yb,zc,abcd->xyzd', *bases, data[...,:3], 
+                     optimize=True)
+    field = fsl_grid(ref) + disp.reshape(-1,3)
+
+    # Map from the linearly-aligned source into the original source 
+    premat = hdr.get_sform()
+    if (np.abs(np.linalg.det(premat)) > 1e-9 
+        and not np.allclose(premat, np.eye(4))): 
+        field = aff_trans(np.linalg.inv(premat), field)
+
+    return field 
+
+
+def fsl_grid(spc):
+    """
+    FSL coordinates of every voxel in an ImageSpace, Nx3, arranged by 
+    voxel index down the rows (as for get_field)
+    """
+
+    return aff_trans(spc.vox2FSL, spc.ijk_grid().reshape(-1,3))
+
+
 def det_jacobian(vec_field, vox_size):
     """
     Calculate determinant of Jacobian for vector field, with homogenous
@@ -11,6 +11,7 @@ from textwrap import dedent
 import nibabel
 import numpy as np 
 from nibabel import Nifti1Image, MGHImage
+from nibabel.spatialimages import SpatialImage
 from fsl.data.image import Image as FSLImage
 
 
@@ -19,7 +20,7 @@ class ImageSpace(object):
     Voxel grid of an image, ignoring actual image data. 
 
     Args: 
-        img: path to image, nibabel Nifti/MGH or FSL Image object
+        img: path to image, nibabel image (eg Nifti/MGH) or FSL Image object
     
     Attributes: 
         size: array of voxel counts in each dimension 
@@ -34,7 +35,7 @@ class ImageSpace(object):
             fname = img 
             img = nibabel.load(img)
         else: 
-            assert isinstance(img, (Nifti1Image, MGHImage, FSLImage))
+            assert isinstance(img, (SpatialImage, FSLImage))
             if type(img) is FSLImage:
                 img = img.nibImage
             fname = img.get_filename()
@@ -340,8 +341,9 @@ class ImageSpace(object):
 
         if isinstance(reg, Registration):
             reg = reg.src2ref
-        if not isinstance(reg, np.ndarray):
-            raise RuntimeError("argument must be a np.array or Registration")
+        # A MotionCorrection is a Registration, but its src2ref is a series
+        if not (isinstance(reg, np.ndarray) and (reg.shape == (4,4))):
+            raise RuntimeError("argument must be a 4x4 np.array or Registration")
 
         new_spc = copy.deepcopy(self)
         new_spc.vox2world = reg @ new_spc.vox2world
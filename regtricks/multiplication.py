@@ -5,7 +5,6 @@ Functions for combining Transformations
 # Lots of relative imports within functions here to avoid circular 
 # imports 
 from collections import defaultdict
-import copy 
 
 import numpy as np 
 
@@ -79,20 +78,24 @@ def moco(lhs, rhs):
 
     from regtricks.transforms import MotionCorrection, Registration
 
+    # The matrices of a MotionCorrection are stored as a (T,4,4) array, 
+    # so each case is a single broadcast matrix product 
+
     # lhs   rhs 
     # reg @ MC
     if type(lhs) is Registration: 
-        overall = [ lhs.src2ref @ m for m in rhs.src2ref ]
+        overall = lhs.src2ref @ rhs.src2ref
 
     # lhs  rhs 
     # MC @ reg
     elif type(rhs) is Registration: 
-        overall = [ m @ rhs.src2ref for m in lhs.src2ref ]
+        overall = lhs.src2ref @ rhs.src2ref
 
     # lhs  rhs 
-    # MC @ MC 
+    # MC @ MC (pairwise, up to the length of the shorter series)
     elif (type(lhs) is MotionCorrection and type(rhs) is MotionCorrection): 
-        overall = [ l @ r for l,r in zip(lhs.src2ref, rhs.src2ref) ]
+        n = min(len(lhs), len(rhs))
+        overall = lhs.src2ref[:n] @ rhs.src2ref[:n]
 
     else:
         raise NotImplementedError("Cannot interpret multiplication of "
@@ -229,12 +232,67 @@ def chain(*args):
     elif len(args) == 2:
         return args[1] @ args[0]
 
+    # Linear transforms only: multiply all the matrices in one reduction 
+    elif linear_chain_possible(args): 
+        return linear_chain(args)
+
     # Everything else: multiply the last one by the chain
     # of the remainder  
     else: 
         return args[-1] @ chain(*args[:-1])
 
 
+def linear_chain_possible(args):
+    """
+    True if a sequence of transforms can be combined by linear_chain(): 
+    all are Registrations or MotionCorrections, and all of the latter 
+    are of the same length. 
+    """
+
+    from regtricks.transforms import Registration, MotionCorrection
+
+    if not all([ type(r) in (Registration, MotionCorrection) for r in args ]):
+        return False 
+    lengths = set([ len(r) for r in args if type(r) is MotionCorrection ])
+    return len(lengths) <= 1 
+
+
+def linear_chain(args):
+    """
+    Concatenate a sequence of Registrations and MotionCorrections (see 
+    linear_chain_possible()), as for chain(). Matrix multiplication is 
+    associative, so the matrices are stacked and multiplied in adjacent 
+    pairs, halving the stack on each pass: log2(N) batched products, 
+    rather than N-1 individual ones. 
+
+    Args: 
+        args: transforms in the order they need to be applied 
+
+    Returns: 
+        Registration, or MotionCorrection if any were given 
+    """
+
+    from regtricks.transforms import Registration, MotionCorrection
+
+    # Stack in reverse order, so the overall transform is the product of 
+    # the stack from the front. MotionCorrections are (T,4,4) and the 
+    # matrix of each Registration is repeated to match. 
+    shape = max([ r.src2ref.shape for r in args ], key=len)
+    mats = np.stack([ np.broadcast_to(r.src2ref, shape) 
+                      for r in args[::-1] ])
+
+    while mats.shape[0] > 1: 
+        paired = mats[0:-1:2] @ mats[1::2]
+        if mats.shape[0] % 2: 
+            paired = np.concatenate((paired, mats[-1:]))
+        mats = paired 
+
+    if len(shape) == 3: 
+        return MotionCorrection(mats[0])
+    else: 
+        return Registration(mats[0])
+
+
 def cast_potential_array(arr):
     """Helper to convert 4x4 arrays to Registrations if not already"""
 
@@ -242,7 +300,6 @@ def cast_potential_array(arr):
 
     if type(arr) is np.ndarray: 
         assert arr.shape == (4,4)
-        arr = copy.deepcopy(arr)
         arr = Registration(arr)
     else: 
         if not isinstance(arr, Transform):
@@ -1,5 +1,6 @@
 import os.path as op 
 from textwrap import dedent
+import functools
 import glob 
 import os 
 
@@ -14,6 +15,37 @@ from regtricks import application_helpers as apply
 from regtricks import multiplication as multiply
 from regtricks.transforms.transform import Transform
 
+
+def _affine_inverse(mats):
+    """
+    Invert a stack of affine matrices (..., 4, 4), exploiting their 
+    structure: the inverse of [R t; 0 1] is [R^-1, -R^-1 t; 0 1], where 
+    R^-1 is found from the closed form (cofactors) of a 3x3 inverse. 
+    For a series this is vectorised over all matrices at once, which is 
+    quicker than a batched np.linalg.inv on the full 4x4 matrices. As for
+    np.linalg.inv, a LinAlgError is raised if any matrix is singular. 
+    """
+
+    R = mats[...,:3,:3]
+    (a, b, c), (d, e, f), (g, h, i) = [ 
+        [ R[...,r,col] for col in range(3) ] for r in range(3) ]
+
+    # Cofactors, arranged as the adjugate (transposed cofactor matrix)
+    adj = np.stack([ e*i - f*h, c*h - b*i, b*f - c*e, 
+                     f*g - d*i, a*i - c*g, c*d - a*f, 
+                     d*h - e*g, b*g - a*h, a*e - b*d ], axis=-1)
+    det = a * adj[...,0] + b * adj[...,3] + c * adj[...,6]
+    if (np.abs(det) < 1e-12).any():
+        raise np.linalg.LinAlgError("Singular matrix")
+    Rinv = adj.reshape(R.shape) / det[...,None,None]
+
+    inv = np.zeros(mats.shape)
+    inv[...,:3,:3] = Rinv
+    inv[...,:3,3] = -(Rinv @ mats[...,:3,3:])[...,0]
+    inv[...,3,3] = 1 
+    return inv 
+
+
 class Registration(Transform):
     """
     Affine (4x4) transformation between two images.
@@ -24,13 +56,18 @@ class Registration(Transform):
 
     def __init__(self, src2ref):
         Transform.__init__(self)
+        self._vox_mat = None 
 
         if isinstance(src2ref, str): 
             src2ref = np.loadtxt(src2ref)
 
+        # Copied, and made read-only, so the cached inverse cannot go stale
+        src2ref = np.array(src2ref, dtype=float)
+        src2ref.setflags(write=False)
+
         if (src2ref.shape != (4,4) 
             or (np.abs(src2ref[3,:] - [0,0,0,1]) > 1e-9).any()):
-            raise RuntimeError("src2ref must be a 4x4 affine matrix, where ",
+            raise RuntimeError("src2ref must be a 4x4 affine matrix, where "
                                "the last row is [0,0,0,1].")
 
         self.__src2ref = src2ref
@@ -78,9 +115,13 @@ class Registration(Transform):
                                {self.src2ref[3,:]}""")
         return dedent(text)
     
-    @property
+    @functools.cached_property
     def ref2src(self):
-        return np.linalg.inv(self.__src2ref)
+        # src2ref is never modified after construction, so the 
+        # inverse need only be calculated once 
+        ref2src = np.linalg.inv(self.__src2ref)
+        ref2src.setflags(write=False)
+        return ref2src
 
     @property
     def src2ref(self):
@@ -121,19 +162,39 @@ class Registration(Transform):
         m = self.to_fsl(src, ref)
         np.savetxt(path, m)
 
-    def prepare_cache(self, ref):
+    def prepare_cache(self, src, ref):
         """
-        Cache re-useable data before interpolate_and_scale. Just the voxel
-        index grid of the reference space is stored
+        Cache re-useable data before interpolate_and_scale. As the same
+        transform applies to every volume, the voxel index grid of the 
+        reference space is mapped into source voxel coordinates once and 
+        the result is stored
+
+        Args: 
+            src (ImageSpace): in which data currently exists 
+            ref (ImageSpace): in which data needs to be expressed
         """
 
-        self.cache = ref.ijk_grid('ij').reshape(-1, 3)
+        # Array of all voxel indices in the reference grid
+        # Map them into world coordinates, apply the transform
+        # and then into source voxel coordinates for the interpolation 
+        # (stored in single precision, ample for voxel coordinates) 
+        ref2src_vox = ((src.world2vox @ self.ref2src) @ ref.vox2world)
+        ijk = ref.ijk_grid('ij').reshape(-1, 3)
+        self.cache = apply.aff_trans(ref2src_vox, ijk).T.astype(np.float32)
+        self._vox_mat = ref2src_vox[:3,:]
+
+    def reset_cache(self):
+        Transform.reset_cache(self)
+        self._vox_mat = None 
+
+    def voxel_matrix(self, *unused):
+        return self._vox_mat 
 
     def resolve(self, src, ref, *unused):
         """
         Return a coordinate array and scale factor that maps reference voxels
-        into source voxels, including the transform. Uses cached values, if
-        available. 
+        into source voxels, including the transform. Uses the coordinates 
+        stored by prepare_cache(), which are the same for every volume. 
 
         Args: 
             src (ImageSpace): in which data currently exists and interpolation
@@ -145,13 +206,7 @@ class Registration(Transform):
                 scale factor
         """
 
-        # Array of all voxel indices in the reference grid
-        # Map them into world coordinates, apply the transform
-        # and then into source voxel coordinates for the interpolation 
-        ref2src_vox = ((src.world2vox @ self.ref2src) @ ref.vox2world)
-        ijk = apply.aff_trans(ref2src_vox, self.cache).T
-        scale = 1 
-        return (ijk, scale)
+        return (self.cache, 1)
 
 
 class MotionCorrection(Registration):
@@ -166,6 +221,7 @@ class MotionCorrection(Registration):
 
     def __init__(self, mats):
         Transform.__init__(self)
+        self._ref2src_vox = None 
 
         if isinstance(mats, str):
             if op.isdir(mats): 
@@ -179,14 +235,27 @@ class MotionCorrection(Registration):
                                      "should be sized (4xN) x 4.")
                 mats = [ mat[i*4:(i+1)*4,:] for i in range(mat.shape[0] // 4) ]
 
-            
-        self.__transforms = []
-        for mat in mats:
-            if isinstance(mat, (np.ndarray, str)): 
-                m = Registration(mat)
-            else: 
-                m = mat 
-            self.__transforms.append(m)
+
+        # The series is stored as a single (T,4,4) array of src2ref matrices;
+        # Registration objects for each volume are only created on request
+        if isinstance(mats, np.ndarray) and (mats.ndim == 3): 
+            if (mats.shape[1:] != (4,4) 
+                or (np.abs(mats[:,3,:] - [0,0,0,1]) > 1e-9).any()):
+                raise RuntimeError("src2ref must be a 4x4 affine matrix, where "
+                                   "the last row is [0,0,0,1].")
+            src2ref = mats 
+        else: 
+            src2ref = []
+            for mat in mats:
+                if isinstance(mat, (np.ndarray, str)): 
+                    m = Registration(mat)
+                else: 
+                    m = mat 
+                src2ref.append(m.src2ref)
+
+        self.__src2ref = np.array(src2ref, dtype=float).reshape(-1,4,4)
+        self.__src2ref.setflags(write=False)
+        self.__transforms = None 
 
     def from_flirt(self, *args):
         raise NotImplementedError("Use the MotionCorrection.from_mcflirt() method")
@@ -228,7 +297,7 @@ class MotionCorrection(Registration):
         return MotionCorrection([ Registration.from_flirt(m, src, ref) for m in mats ])
 
     def __len__(self):
-        return len(self.transforms)
+        return self.__src2ref.shape[0]
 
     def __repr__(self):
         t = self[0]
@@ -246,7 +315,7 @@ class MotionCorrection(Registration):
 
     def __getitem__(self, idx):
         """Access individual Registration objects from within series"""
-        return self.__transforms[idx]
+        return self.transforms[idx]
 
     @classmethod
     def identity(cls, length):
@@ -264,17 +333,21 @@ class MotionCorrection(Registration):
     @property 
     def transforms(self):
         """List of Registration objects representing each volume of transform"""
+        if self.__transforms is None: 
+            self.__transforms = [ Registration(m) for m in self.__src2ref ]
         return self.__transforms
 
     @property 
     def src2ref(self):
-        """List of src to ref transformation matrices"""
-        return [ t.src2ref for t in self.transforms ]
+        """Array (T,4,4) of src to ref transformation matrices"""
+        return self.__src2ref
 
-    @property
+    @functools.cached_property
     def ref2src(self):
-        """List of ref to src transformation matrices"""
-        return [ t.ref2src for t in self.transforms ]
+        """Array (T,4,4) of ref to src transformation matrices"""
+        ref2src = _affine_inverse(self.__src2ref)
+        ref2src.setflags(write=False)
+        return ref2src
 
     def to_fsl(self, src, ref):
         """Transformation matrices in FSL terms"""
@@ -308,6 +381,37 @@ class MotionCorrection(Registration):
             m = r.to_fsl(src, ref)
             np.savetxt(p, m)
 
+    def prepare_cache(self, src, ref):
+        """
+        Cache re-useable data before interpolate_and_scale. The voxel-to-
+        voxel matrices of the whole series are calculated together. The 
+        compiled kernels and GPU backends use these directly via 
+        voxel_matrix(); the homogeneous voxel grid of the reference (4xN), 
+        from which resolve() forms each volume's coordinates with a single
+        matrix product, is only built by resolve() when first needed
+
+        Args: 
+            src (ImageSpace): in which data currently exists 
+            ref (ImageSpace): in which data needs to be expressed
+        """
+
+        # Map the reference voxels into world coordinates, apply the 
+        # transform, and then into source voxel coordinates. All of the 
+        # matrices in the series are inverted and combined in one go, 
+        # the last row of each is dropped as it is not needed. Single 
+        # precision is used for the coordinates. 
+        ref2src_vox = (src.world2vox @ self.ref2src) @ ref.vox2world
+        self._ref2src_vox = ref2src_vox[:,:3,:].astype(np.float32)
+
+    def reset_cache(self):
+        Transform.reset_cache(self)
+        self._ref2src_vox = None 
+
+    def voxel_matrix(self, at_idx):
+        if self._ref2src_vox is None: 
+            return None 
+        return self._ref2src_vox[at_idx]
+
     def resolve(self, src, ref, at_idx):
         """
         Return a coordinate array and scale factor that maps reference voxels
@@ -325,12 +429,13 @@ class MotionCorrection(Registration):
                 scale factor
         """
         
-        # Array of all voxel indices in the reference grid
-        # Map them into world coordinates, apply the transform
-        # and then into source voxel coordinates for the interpolation 
-        ref2src_vox = (src.world2vox 
-                       @ self.ref2src[at_idx]
-                       @ ref.vox2world)
-        ijk = apply.aff_trans(ref2src_vox, self.cache).T
+        # Single product of this volume's ref2src voxel matrix with 
+        # the homogeneous voxel grid of the reference. Threads that 
+        # race to build the grid each assign an identical array. 
+        if self.cache is None: 
+            ijk = ref.ijk_grid('ij').reshape(-1, 3).T
+            self.cache = np.vstack((ijk, np.ones((1, ijk.shape[1])))
+                                   ).astype(np.float32)
+        ijk = self._ref2src_vox[at_idx] @ self.cache
         scale = 1
         return ijk, scale
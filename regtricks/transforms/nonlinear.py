@@ -147,7 +147,7 @@ class NonLinearRegistration(Transform):
         """)
         return dedent(text)
 
-    def prepare_cache(self, ref):
+    def prepare_cache(self, src, ref):
         """
         Pre-compute and store the displacement field, including any postmats. 
         This is because premats can be applied after calculating the field, 
@@ -156,6 +156,7 @@ class NonLinearRegistration(Transform):
         be cached (which implies a NLMC)
 
         Args: 
+            src (ImageSpace): in which data currently exists (unused)
             ref (ImageSapce): the space in towards which the transform will
                 be applied 
         """
@@ -163,6 +164,10 @@ class NonLinearRegistration(Transform):
         if self.cache is None: 
             assert type(self) is NonLinearMotionCorrection
 
+            # Displacements will be resolved for each volume in turn, 
+            # prepare the values shared between them once here 
+            self.warp.prepare_displacements()
+
     def resolve(self, src, ref, *unused):
         """
         Return a coordinate array and scale factor that maps reference voxels
@@ -2,6 +2,7 @@ import os.path as op
 from textwrap import dedent
 from multiprocessing import cpu_count
 
+import nibabel
 from nibabel import Nifti1Image, MGHImage
 import numpy as np 
 from fsl.data.image import Image as FSLImage
@@ -12,7 +13,13 @@ from regtricks import application_helpers as apply
 from regtricks import multiplication as multiply
 
 # cache for intensity correction?
-# cast_space method 
+
+def _cast_space(spc):
+    """ImageSpace for spc, which may already be one, or an image / path"""
+    if isinstance(spc, ImageSpace):
+        return spc 
+    return ImageSpace(spc)
+
 
 class Transform(object):
     """
@@ -50,6 +57,15 @@ class Transform(object):
     def reset_cache(self):
         self.cache = None 
 
+    def voxel_matrix(self, at_idx):
+        """
+        Affine (3x4) that maps reference voxels into source voxels for 
+        volume at_idx, available after prepare_cache() for linear 
+        transforms only (otherwise None).
+        """
+
+        return None 
+
     @property
     def cache(self):
         return self._cache
@@ -103,7 +119,8 @@ class Transform(object):
             raise NotImplementedError("Not Transformation objects")
 
     def apply_to_image(self, src, ref, order=3, superfactor=True, 
-                        cores=cpu_count(), cval=0.0, **kwargs):
+                        cores=cpu_count(), cval=0.0, backend='thread', 
+                        **kwargs):
         """
         Applies transformation to data array. If a registration is applied 
         to 4D data, the same transformation will be applied to all volumes 
@@ -118,19 +135,25 @@ class Transform(object):
                 applywarp -super), enabled by default when resampling from 
                 high to low resolution. Set as False to disable, or set an 
                 int/iterable to manually specify level for each image dimension. 
-            cores (int): CPU cores to use for 4D data
+            cores (int): CPU cores to use
             cval (float): fill value for locations outside of the image
+            backend (str): 'thread' (default) or 'process', how to share
+                the volumes of 4D data amongst cores, or 'cupy' / 'torch'
+                for GPU (torch: order 0 or 1 only) 
             **kwargs: passed on to scipy.ndimage.map_coordinates
 
         Returns: 
             (np.array) transformed image data in ref voxel grid.
         """
 
+        # Paths are loaded once, the image serving for both data and space
+        if isinstance(src, str): 
+            src = nibabel.load(src)
         data, creator = apply.src_load_helper(src)
+        src = _cast_space(src)
+        ref = _cast_space(ref)
         resamp = self.apply_to_array(data, src, ref, order, superfactor, 
-                                     cores, cval, **kwargs)
-        if not isinstance(ref, ImageSpace):
-            ref = ImageSpace(ref)
+                                     cores, cval, backend, **kwargs)
         
         if creator is MGHImage:
             ret = MGHImage(resamp, ref.vox2world, ref.header)
@@ -143,7 +166,8 @@ class Transform(object):
                 return ret 
 
     def apply_to_array(self, data, src, ref, order=3, superfactor=True,
-                        cores=cpu_count(), cval=0.0, **kwargs):
+                        cores=cpu_count(), cval=0.0, backend='thread', 
+                        **kwargs):
         """
         Applies transformation to data array. If a registration is applied 
         to 4D data, the same transformation will be applied to all volumes 
@@ -159,18 +183,19 @@ class Transform(object):
                 applywarp -super), enabled by default when resampling from 
                 high to low resolution. Set as False to disable, or set an 
                 int/iterable to manually specify level for each image dimension. 
-            cores (int): CPU cores to use for 4D data
+            cores (int): CPU cores to use
             cval (float): fill value for locations outside of the image
+            backend (str): 'thread' (default) or 'process', how to share
+                the volumes of 4D data amongst cores, or 'cupy' / 'torch'
+                for GPU (torch: order 0 or 1 only) 
             **kwargs: passed on to scipy.ndimage.map_coordinates
 
         Returns: 
             (np.array) transformed image data in ref voxel grid.
         """
 
-        if not isinstance(src, ImageSpace):
-            src = ImageSpace(src)
-        if not isinstance(ref, ImageSpace):
-            ref = ImageSpace(ref)
+        src = _cast_space(src)
+        ref = _cast_space(ref)
 
         # Create super-resolution reference grid if necessary
         # Automatic is to use the ratio of input / output voxel size,
@@ -196,18 +221,18 @@ class Transform(object):
         if (superfactor != 1).any(): 
             ref = ref.resize_voxels(1 / superfactor, 'ceil')
 
-        if not ((data.ndim in (3,4)) and (np.array_equal(src.size, data.shape[:3]))): 
+        src_size = tuple(int(x) for x in src.size)
+        if (data.ndim not in (3,4)) or (data.shape[:3] != src_size): 
             raise ValueError("Data shape {} does not match source space {}"
                                 .format(data.shape, src.size))
 
-        # Force to float data 
+        # Force to float data (float32, unless already floating point)
         if data.dtype.kind != 'f': 
-            data = data.astype(float)
+            data = data.astype(np.float32)
 
-        # Only use multiprocessing on 4D data 
-        if data.ndim == 3: 
-            cores = 1 
-        else: 
+        # For 4D data, no more cores than volumes. 3D data may still use
+        # multiple cores within the compiled interpolation kernels 
+        if data.ndim == 4: 
             cores = min([cores, data.shape[-1]])
 
         kwargs.update({
@@ -215,6 +240,7 @@ class Transform(object):
             'superfactor': superfactor,
             'order': order
             })
-        resamp = apply.despatch(data, self, src, ref, cores, **kwargs)
+        resamp = apply.despatch(data, self, src, ref, cores, backend, 
+                                **kwargs)
 
         return resamp      
\ No newline at end of file
@@ -92,4 +92,9 @@ if __name__ == "__main__":
         license='BSD-3-clause', 
         url='https://github.com/tomfrankkirk/regtricks',
         install_requires=get_requirements(),
+        extras_require={
+            'numba': ['numba'],
+            'torch': ['torch'],
+            'cupy': ['cupy-cuda12x'],
+        },
         packages=find_packages())
\ No newline at end of file
@@ -6,6 +6,8 @@ from nibabel import Nifti1Image, MGHImage
 from fsl.data.image import Image as FSLImage
 import tempfile 
 import os.path as op 
+import pytest
+from regtricks import _cupy, _torch
 
 LAST_ROW = [0,0,0,1]
 MAT = np.vstack((np.random.rand(3,4), LAST_ROW))
@@ -69,6 +71,25 @@ def test_inverse():
         assert np.allclose(invm, np.linalg.inv(m))
 
 
+def test_cached_inverse():
+    m = MAT.copy()
+    r = rt.Registration(m)
+    r.ref2src
+    m[0,3] += 1 
+    assert np.allclose(r.ref2src @ r.src2ref, np.eye(4))
+    for t in (r, rt.MotionCorrection(MATS)):
+        for a in (t.src2ref, t.ref2src):
+            with pytest.raises(ValueError):
+                a[...] = 0 
+
+
+def test_singular_inverse():
+    mats = np.stack(MATS)
+    mats[3,:3,2] = 0 
+    with pytest.raises(np.linalg.LinAlgError):
+        rt.MotionCorrection(mats).ref2src
+
+
 def test_mcflirt_shape_casting():
     m = 10 * [ np.eye(4) ]
     m = np.concatenate(m, axis=0)
@@ -98,6 +119,20 @@ def test_type_promotion():
     assert type(x) is rt.Registration
 
 
+def test_linear_chain():
+    regs = [ rt.Registration(m) for m in MATS[:5] ]
+    mcs = [ rt.MotionCorrection(MATS[:6]), rt.MotionCorrection(MATS[4:]) ]
+    mixed = [ regs[0], mcs[0], regs[1], mcs[1], regs[2] ]
+    short = [ regs[0], rt.MotionCorrection(MATS), regs[1], mcs[0] ]
+    for args in (regs, mixed, short): 
+        t = args[0]
+        for a in args[1:]: 
+            t = a @ t 
+        c = rt.chain(*args)
+        assert type(c) is type(t)
+        assert np.allclose(c.src2ref, t.src2ref)
+
+
 def test_fsl_inverse(): 
     r = rt.Registration(MAT)
     assert np.allclose(np.linalg.inv(r.to_fsl(SPC1, SPC2)), r.inverse().to_fsl(SPC2, SPC1))
@@ -115,6 +150,13 @@ def test_imagespace_resize_voxels():
     assert np.allclose(2 * SPC1.vox2world[:3,:3], s2.vox2world[:3,:3])
 
 
+def test_imagespace_transform():
+    spc = SPC1.transform(rt.Registration(MAT))
+    assert np.allclose(spc.vox2world, MAT @ SPC1.vox2world)
+    with pytest.raises(RuntimeError):
+        SPC1.transform(rt.MotionCorrection(MATS))
+
+
 def test_image_types():
 
     r = rt.Registration.identity()
@@ -128,6 +170,21 @@ def test_image_types():
         assert type(img) is type(img2)
 
 
+def test_analyze_image():
+    # Analyze cannot store an arbitrary affine, so the space is re-read
+    v = np.random.rand(*SPC1.size).astype(np.float32)
+    r = rt.Registration(MAT)
+    with tempfile.TemporaryDirectory() as d: 
+        path = op.join(d, 'img.img')
+        nibabel.save(nibabel.AnalyzeImage(v, SPC1.vox2world), path)
+        img = nibabel.load(path)
+        t = r.apply_to_array(v, rt.ImageSpace(img), SPC1, order=1)
+        for src in (path, img): 
+            x = r.apply_to_image(src, SPC1, order=1)
+            assert isinstance(x, Nifti1Image)
+            assert np.allclose(x.get_fdata(), t)
+
+
 def test_apply_array(): 
     r = rt.Registration.identity()
     v = np.zeros((10,10,10), dtype=np.float32)
@@ -153,6 +210,207 @@ def test_undersized_input():
         assert str(e).startswith('Data shape (10, 10) does not match source space [10 10 10]') 
 
 
+def test_aff_trans():
+    from regtricks.application_helpers import aff_trans
+    p = np.random.rand(20, 3)
+    t = (MAT @ np.vstack((p.T, np.ones(20))))[:3,:]
+    assert np.allclose(aff_trans(MAT, p), t.T)
+    assert np.allclose(aff_trans(MAT, p.T), t)
+
+
+def test_sum_array_blocks():
+    from regtricks.application_helpers import sum_array_blocks
+    x = np.random.rand(4, 6, 8, 2)
+    s = sum_array_blocks(x, (2, 3, 4, 1))
+    assert s.shape == (2, 2, 2, 2)
+    assert np.allclose(s[1,0,1,:], x[2:4,0:3,4:8,:].sum(axis=(0,1,2)))
+
+
+def test_separable_linear():
+    from scipy.ndimage import map_coordinates
+    from regtricks.application_helpers import _separable_linear, aff_trans
+    v = np.random.rand(*SPC1.size)
+    m = np.diag([0.8, -1.1, 1.5, 1])
+    m[:3,3] = [0.7, 9.3, -2.4]
+    ijk = aff_trans(m, SPC1.ijk_grid().reshape(-1,3)).T
+    x = _separable_linear(v, m[:3,:], SPC1.size, cval=0.5)
+    t = map_coordinates(v, ijk, order=1, cval=0.5)
+    assert np.allclose(x, t)
+
+
+def test_affine_trilinear():
+    from scipy.ndimage import map_coordinates
+    from regtricks import _interp
+    from regtricks.application_helpers import aff_trans
+    if not _interp.HAVE_NUMBA:
+        return
+    v = np.random.rand(*SPC1.size)
+    m = np.eye(4)
+    m[:2,:2] = [[0.9, -0.2], [0.2, 0.9]]
+    m[:3,3] = [0.73, -1.37, 2.41]
+    ijk = aff_trans(m, SPC1.ijk_grid().reshape(-1,3)).T
+    x = _interp.affine_trilinear(v, m[:3,:], SPC1.size, cval=0.5)
+    t = map_coordinates(v, ijk, order=1, cval=0.5)
+    assert np.allclose(x, t)
+
+
+def test_trilinear_nan():
+    from scipy.ndimage import map_coordinates
+    from regtricks import _interp
+    if not _interp.HAVE_NUMBA:
+        return
+    v = np.random.rand(*SPC1.size).astype(np.float32)
+    ijk = np.array([[np.nan, 1, 2.5], [1, np.nan, 3], [2, 4, 1.5]], 
+                   dtype=np.float32)
+    x = _interp.trilinear(v, ijk, cval=-9.0)
+    t = map_coordinates(v, ijk, order=1, cval=-9.0)
+    assert np.allclose(x, t)
+
+
+def test_linear_matches_scipy():
+    from scipy.ndimage import map_coordinates
+    from regtricks.application_helpers import aff_trans
+    v = np.random.rand(*SPC1.size)
+    r = rt.Registration(MAT)
+    x = r.apply_to_array(v, SPC1, SPC1, order=1, superfactor=False, cval=0.5)
+    ijk = aff_trans(SPC1.world2vox @ r.ref2src @ SPC1.vox2world, 
+                    SPC1.ijk_grid().reshape(-1,3)).T
+    t = map_coordinates(v, ijk, order=1, cval=0.5).reshape(SPC1.size)
+    assert np.allclose(x, t)
+
+
+def test_process_backend():
+    mc = rt.MotionCorrection(MATS)
+    v = np.random.rand(*SPC1.size, len(MATS))
+    kw = dict(order=1, superfactor=False, cores=2)
+    x = mc.apply_to_array(v, SPC1, SPC1, backend='process', **kw)
+    t = mc.apply_to_array(v, SPC1, SPC1, backend='thread', **kw)
+    assert np.allclose(x, t)
+
+
+def _affine_warp(aff, spc):
+    from regtricks.fnirt_coefficients import FNIRTCoefficients, fsl_grid
+    from regtricks.application_helpers import aff_trans
+    disp = aff_trans(aff, fsl_grid(spc)) - fsl_grid(spc)
+    img = Nifti1Image(disp.reshape(*spc.size, 3), spc.vox2world)
+    return FNIRTCoefficients(img, spc, spc)
+
+
+def test_sample_displacements():
+    from regtricks.fnirt_coefficients import NonLinearProduct, fsl_grid
+    from regtricks.application_helpers import aff_trans
+
+    def interior(spc, points, margin=3):
+        ijk = aff_trans(spc.FSL2vox, points)
+        return ((ijk >= margin) & (ijk <= spc.size - 1 - margin)).all(1)
+
+    # Warps that are affine in FSL coordinates are reproduced closely by 
+    # their spline coefficients, away from the edges of the grid 
+    a1, a2 = np.eye(4), np.eye(4)
+    a1[:3,:] += np.random.rand(3,4) * [0.05, 0.05, 0.05, 2]
+    a2[:3,:] += np.random.rand(3,4) * [0.05, 0.05, 0.05, 2]
+    ref = rt.ImageSpace.create_axis_aligned(np.zeros(3), (20,22,18), 2 * np.ones(3))
+    out = ref.resize_voxels(1.5)
+    w1, w2 = _affine_warp(a1, ref), _affine_warp(a2, ref)
+    post, mid = [ rt.Registration(np.eye(4) + np.pad(
+                  np.random.rand(3,4) * 0.02, ((0,1),(0,0)))) for _ in range(2) ]
+
+    pts = aff_trans(np.linalg.inv(post.to_fsl(ref, out)), fsl_grid(out))
+    inside = interior(ref, pts)
+    d = w1.get_displacements(out, post)
+    assert inside.any()
+    assert np.allclose(d[inside], aff_trans(a1, pts[inside]), atol=1e-3)
+
+    nlp = NonLinearProduct(w2, mid, rt.Registration.identity(), w1)
+    pts = aff_trans(np.linalg.inv(nlp.midmat.to_fsl(ref, ref)) @ a1, pts)
+    inside = inside & interior(ref, pts)
+    d = nlp.get_displacements(out, post)
+    assert inside.any()
+    assert np.allclose(d[inside], aff_trans(a2, pts[inside]), atol=1e-3)
+    assert np.allclose(nlp.get_cache_value(out, post), d)
+
+
+def test_chain_nonlinear():
+    # Composed in process, so convertwarp is not needed. Whole voxel shifts
+    # so that interpolating twice is exact 
+    ref = rt.ImageSpace.create_axis_aligned(np.zeros(3), (20,22,18), 2 * np.ones(3))
+    a = np.eye(4)
+    a[:3,3] = [2, -2, 2]
+    nlr = rt.NonLinearRegistration.from_fnirt(
+            _affine_warp(a, ref).coefficients, ref, ref)
+    v = np.random.rand(*ref.size)
+    x = rt.chain(nlr, nlr).apply_to_array(v, ref, ref, order=1)
+    t = nlr.apply_to_array(nlr.apply_to_array(v, ref, ref, order=1), 
+                           ref, ref, order=1)
+    assert np.allclose(x[4:-4,4:-4,4:-4], t[4:-4,4:-4,4:-4], atol=1e-2)
+
+
+def test_cubic_bspline_field():
+    from fsl.transform.fnirt import readFnirt
+    from regtricks.fnirt_coefficients import cubic_bspline_field, fsl_grid
+    from regtricks.application_helpers import aff_trans
+
+    aff = np.diag([2, 2, 2, 1])
+    aff[:3,3] = [-20, -22, -18]
+    premat = np.eye(4)
+    premat[:3,3] = [1, -2, 0.5]
+    coef = np.random.normal(0, 1.5, (8,9,8,3)).astype(np.float32)
+    h = nibabel.Nifti1Header()
+    h.set_data_dtype(np.float32)
+    h.set_data_shape(coef.shape)
+    h.set_sform(premat, 1)
+    h.set_qform(np.eye(4), 1)
+    h.set_zooms((3, 3, 3, 1))
+    h['intent_code'] = 2007
+    for k in ('intent_p1', 'intent_p2', 'intent_p3'):
+        h[k] = 2
+
+    with tempfile.TemporaryDirectory() as d: 
+        refpath = op.join(d, 'ref.nii.gz')
+        coefpath = op.join(d, 'coef.nii.gz')
+        nibabel.save(Nifti1Image(np.zeros((20,22,18), np.float32), aff), refpath)
+        nibabel.save(Nifti1Image(coef, None, h), coefpath)
+        ref = rt.ImageSpace(refpath)
+        field = readFnirt(coefpath, FSLImage(refpath), FSLImage(refpath))
+        x = cubic_bspline_field(nibabel.load(coefpath), ref)
+        t = field.displacements(ref.ijk_grid('ij').reshape(-1,3))
+
+    # fslpy's displacements exclude the premat, which is applied to the 
+    # absolute field as convertwarp does 
+    t = fsl_grid(ref) + t
+    assert np.allclose(x, aff_trans(np.linalg.inv(premat), t), atol=1e-4)
+
+
+@pytest.mark.skipif(not _cupy.HAVE_CUPY, reason="cupy not installed")
+def test_cupy_backend():
+    mats = [ np.eye(4) + np.pad(np.random.rand(3,4) * 0.05, ((0,1),(0,0))) 
+             for _ in range(5) ]
+    v = np.random.rand(*SPC1.size, len(mats))
+    ref = SPC1.resize_voxels(2)
+    for t in (rt.Registration(mats[0]), rt.MotionCorrection(mats)):
+        for sf in (False, True): 
+            kw = dict(order=1, superfactor=sf)
+            x = t.apply_to_array(v, SPC1, ref, backend='cupy', **kw)
+            y = t.apply_to_array(v, SPC1, ref, backend='thread', **kw)
+            assert (x > 0).mean() > 0.5
+            assert np.allclose(x, y, atol=1e-5)
+
+
+@pytest.mark.skipif(not _torch.HAVE_TORCH, reason="torch not installed")
+def test_torch_backend():
+    mats = [ np.eye(4) + np.pad(np.random.rand(3,4) * 0.05, ((0,1),(0,0))) 
+             for _ in range(5) ]
+    v = np.random.rand(*SPC1.size, len(mats))
+    ref = SPC1.resize_voxels(2)
+    for t in (rt.Registration(mats[0]), rt.MotionCorrection(mats)):
+        for sf in (False, True): 
+            kw = dict(order=1, superfactor=sf)
+            x = t.apply_to_array(v, SPC1, ref, backend='torch', **kw)
+            y = t.apply_to_array(v, SPC1, ref, backend='thread', **kw)
+            assert (x > 0).mean() > 0.5
+            assert np.allclose(x, y, atol=1e-5)
+
+
 def test_mcasl():
     r = rt.MotionCorrection.from_mcflirt('testdata/mcasl.mat', ASLT, ASLT)
     x = r.apply_to_image(ASL, ASLT, order=1)